@@ -0,0 +1,125 @@
+"""
+Pro Access Tokens
+
+HS256 JWT minting and verification for Pro entitlement tokens.
+"""
+
+import os
+import base64
+import hmac
+import hashlib
+import time
+from typing import Optional, Dict, Any
+
+import orjson
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+# Load environment variables from .env file (this module can be imported before database.py)
+load_dotenv()
+
+JWT_SECRET = os.getenv("JWT_SECRET", "dev_secret_change_me")
+JWT_ISSUER = os.getenv("JWT_ISSUER", "runner-metronome")
+JWT_AUDIENCE = os.getenv("JWT_AUDIENCE", "runner-metronome-app")
+JWT_EXP_HOURS = int(os.getenv("JWT_EXP_HOURS", "720"))  # 30 days default
+
+JWT_SECRET_BYTES = JWT_SECRET.encode("utf-8")
+
+def base64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def base64url_decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+# PyJWT is only needed for strict decoding on /api/pro/verify; import it on first use
+_JWT = None
+
+
+def _get_jwt():
+    global _JWT
+    if _JWT is None:
+        import jwt
+        _JWT = jwt.PyJWT()
+    return _JWT
+
+
+# Decode arguments are reused; the HS256 header never changes, so it is encoded once
+_JWT_ALGORITHMS = ("HS256",)
+_JWT_DECODE_OPTIONS = {"verify_signature": True, "require": ["exp", "iat", "iss", "aud"]}
+_JWT_HEADER_SEGMENT = base64url_encode(b'{"alg":"HS256","typ":"JWT"}')
+_JWT_BASE_CLAIMS = {"pro": True, "iss": JWT_ISSUER, "aud": JWT_AUDIENCE}
+_JWT_TTL_SECONDS = JWT_EXP_HOURS * 3600
+
+
+# Clients resend the same token on every request; remember verified claims for up to
+# 5 seconds, and never past the token's own exp. Only successful verifications are kept.
+# Strict (PyJWT) and fast verifications are cached apart: fast_verify checks less, so
+# decode_jwt must only trust tokens it decoded itself.
+_STRICT_VERIFIED_TOKENS: TTLCache = TTLCache(maxsize=10_000, ttl=5)
+_FAST_VERIFIED_TOKENS: TTLCache = TTLCache(maxsize=10_000, ttl=5)
+
+
+def _cached_claims(cache: TTLCache, token: str) -> Optional[Dict[str, Any]]:
+    entry = cache.get(token)
+    if entry is not None and time.time() < entry[0]:
+        return entry[1]
+    return None
+
+
+def _remember_claims(cache: TTLCache, token: str, claims: Dict[str, Any]):
+    cache[token] = (claims["exp"], claims)
+
+
+def decode_jwt(token: str) -> Dict[str, Any]:
+    claims = _cached_claims(_STRICT_VERIFIED_TOKENS, token)
+    if claims is None:
+        claims = _get_jwt().decode(token, JWT_SECRET, algorithms=_JWT_ALGORITHMS, audience=JWT_AUDIENCE, issuer=JWT_ISSUER, options=_JWT_DECODE_OPTIONS)
+        _remember_claims(_STRICT_VERIFIED_TOKENS, token, claims)
+    return claims
+
+
+def fast_verify(token: str) -> Optional[Dict[str, Any]]:
+    """
+    Check a token we minted (HS256 signature, exp, iss, aud) and return its claims, or None.
+    Cheaper than the full PyJWT pipeline; used for the Pro check on read endpoints only,
+    /api/pro/verify keeps strict decoding.
+    """
+    # a strictly verified token also passes the fast checks
+    cached = _cached_claims(_STRICT_VERIFIED_TOKENS, token) or _cached_claims(_FAST_VERIFIED_TOKENS, token)
+    if cached is not None:
+        return cached
+    try:
+        if token.count(".") != 2:
+            return None
+        signing_input, _, signature = token.encode("ascii").rpartition(b".")
+        expected = hmac.new(JWT_SECRET_BYTES, signing_input, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, base64url_decode(signature)):
+            return None
+        claims = orjson.loads(base64url_decode(signing_input.split(b".", 1)[1]))
+    except Exception:
+        return None
+    if not isinstance(claims, dict):
+        return None
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp <= time.time():
+        return None
+    if claims.get("iss") != JWT_ISSUER or claims.get("aud") != JWT_AUDIENCE:
+        return None
+    _remember_claims(_FAST_VERIFIED_TOKENS, token, claims)
+    return claims
+
+
+def mint_jwt(user_id: Optional[str] = None, email: Optional[str] = None) -> str:
+    iat = int(time.time())
+    payload = {
+        "sub": user_id or email or "anon",
+        "email": email,
+        **_JWT_BASE_CLAIMS,
+        "iat": iat,
+        "exp": iat + _JWT_TTL_SECONDS,
+    }
+    signing_input = _JWT_HEADER_SEGMENT + b"." + base64url_encode(orjson.dumps(payload))
+    signature = hmac.new(JWT_SECRET_BYTES, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + base64url_encode(signature)).decode("ascii")
@@ -0,0 +1,219 @@
+"""
+Pace -> BPM Conversion
+
+Heuristic pace to cadence (steps per minute) conversion with run-type offsets and
+personalization, plus the /api/convert/pace-to-bpm routes that expose it.
+"""
+
+import math
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Optional
+
+import orjson
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+router = APIRouter()
+
+RUN_TYPE_OFFSETS = {
+    "easy": -5,
+    "recovery": -8,
+    "long": -3,
+    "tempo": 0,
+    "interval": +5,
+    "sprint": +8,
+}
+
+
+# Pace anchors in min/km -> spm. The curve is sampled once at import into a
+# lookup table at 0.01 min/km resolution so a conversion is a single index.
+_ANCHOR_PACES = (3.0, 4.0, 5.0, 6.0, 7.0, 8.0)
+_ANCHOR_BPMS = (200, 185, 170, 160, 150, 145)
+_LUT_STEPS_PER_MIN = 100
+_LUT_MIN_PACE = _ANCHOR_PACES[0]
+_LUT_MAX_PACE = _ANCHOR_PACES[-1]
+_LUT_OFFSET = int(_LUT_MIN_PACE * _LUT_STEPS_PER_MIN)
+
+
+def _interpolate_anchors(x: float) -> float:
+    # bisect finds the segment in C; clamping i keeps out-of-range x on the end segments
+    i = max(1, min(len(_ANCHOR_PACES) - 1, bisect_left(_ANCHOR_PACES, x)))
+    x1, x2 = _ANCHOR_PACES[i - 1], _ANCHOR_PACES[i]
+    y1, y2 = _ANCHOR_BPMS[i - 1], _ANCHOR_BPMS[i]
+    return y1 + (x - x1) / (x2 - x1) * (y2 - y1)
+
+
+_BPM_LUT = tuple(
+    _interpolate_anchors(i / _LUT_STEPS_PER_MIN)
+    for i in range(_LUT_OFFSET, int(_LUT_MAX_PACE * _LUT_STEPS_PER_MIN) + 1)
+)
+
+
+@lru_cache(maxsize=4096)
+def _bpm_at(lut_index: int, offset: int, baseline_cadence: Optional[int], target_cadence: Optional[int]) -> int:
+    # Memoized on the quantized pace, so nearby paces from the same session share entries
+    bpm = _BPM_LUT[lut_index] + offset
+    if target_cadence:
+        bpm = 0.75 * bpm + 0.25 * target_cadence
+    if baseline_cadence:
+        diff = bpm - baseline_cadence
+        if abs(diff) > 10:
+            bpm -= 2 if diff > 0 else -2
+    bpm_int = int(round(bpm))
+    return max(120, min(220, bpm_int))
+
+
+def _pace_to_bpm_core(pace_min_per_km: float, offset: int, baseline_cadence: Optional[int], target_cadence: Optional[int]) -> int:
+    # Numeric kernel: quantize onto the table, then run-type offset, personalization, clamp
+    x = max(min(pace_min_per_km, _LUT_MAX_PACE), _LUT_MIN_PACE)
+    if math.isnan(x):
+        # NaN slips through the clamp; treat it like the slowest pace, as the segment walk did
+        x = _LUT_MAX_PACE
+    return _bpm_at(int(round(x * _LUT_STEPS_PER_MIN)) - _LUT_OFFSET, offset, baseline_cadence, target_cadence)
+
+
+def pace_to_bpm(pace_value: float, pace_unit: str = "min_per_km", run_type: str = "easy", baseline_cadence: Optional[int] = None, target_cadence: Optional[int] = None) -> int:
+    """
+    Convert pace to target cadence (BPM = steps/minute).
+    Heuristic + personalization.
+    """
+    pace_min_per_km = pace_value if pace_unit == "min_per_km" else pace_value * 0.621371
+    return _pace_to_bpm_core(pace_min_per_km, RUN_TYPE_OFFSETS.get(run_type, 0), baseline_cadence, target_cadence)
+
+
+# Checked by hand rather than with allow_inf_nan=False: FastAPI's 422 handler echoes the
+# input back and can't serialize NaN
+_NON_FINITE_PACE_DETAIL = "pace_value must be a finite number"
+
+
+def _require_finite_pace(pace_value: float):
+    if not math.isfinite(pace_value):
+        raise HTTPException(status_code=422, detail=_NON_FINITE_PACE_DETAIL)
+
+
+class BPMRequest(BaseModel):
+    pace_value: float
+    pace_unit: str = "min_per_km"
+    run_type: str = "easy"
+    baseline_cadence: Optional[int] = None
+    target_cadence: Optional[int] = None
+
+
+@router.post("/api/convert/pace-to-bpm")
+def convert_pace_to_bpm(req: BPMRequest):
+    _require_finite_pace(req.pace_value)
+    bpm = pace_to_bpm(
+        pace_value=req.pace_value,
+        pace_unit=req.pace_unit,
+        run_type=req.run_type,
+        baseline_cadence=req.baseline_cadence,
+        target_cadence=req.target_cadence,
+    )
+    return {"bpm": bpm}
+
+
+# The conversion is deterministic, so the GET form lets browsers and CDNs cache it
+PACE_TO_BPM_CACHE_CONTROL = "public, max-age=86400, immutable"
+
+
+@router.get("/api/convert/pace-to-bpm")
+async def convert_pace_to_bpm_get(
+    request: Request,
+    pace_value: float,
+    pace_unit: str = "min_per_km",
+    run_type: str = "easy",
+    baseline_cadence: Optional[int] = None,
+    target_cadence: Optional[int] = None,
+):
+    _require_finite_pace(pace_value)
+    bpm = pace_to_bpm(
+        pace_value=pace_value,
+        pace_unit=pace_unit,
+        run_type=run_type,
+        baseline_cadence=baseline_cadence,
+        target_cadence=target_cadence,
+    )
+    headers = {"Cache-Control": PACE_TO_BPM_CACHE_CONTROL, "ETag": f'W/"{bpm}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=orjson.dumps({"bpm": bpm}), media_type="application/json", headers=headers)
+
+
+def _route_path(scope) -> str:
+    # Mounted apps see the path relative to the mount point; newer Starlette keeps the
+    # full path and records the prefix in root_path instead.
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    return path
+
+
+async def _send_json(send, status: int, body: bytes, headers: Optional[list] = None):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("ascii")),
+            *(headers or []),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+_BPM_REQUEST_ADAPTER = TypeAdapter(BPMRequest)
+
+
+class FastPaceBPMApp:
+    """
+    Bare ASGI app serving POST /api/convert/pace-to-bpm without Starlette's Request,
+    FastAPI's dependency injection or jsonable_encoder. Mount it under a prefix;
+    the regular FastAPI route stays available for everything else.
+    """
+
+    path = "/api/convert/pace-to-bpm"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if _route_path(scope) != self.path:
+            await _send_json(send, 404, b'{"detail":"Not Found"}')
+            return
+        if scope["method"] != "POST":
+            await _send_json(send, 405, b'{"detail":"Method Not Allowed"}', [(b"allow", b"POST")])
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        try:
+            # parse and validate in one pass inside pydantic-core
+            req = _BPM_REQUEST_ADAPTER.validate_json(body)
+        except ValidationError as e:
+            detail = e.errors(include_url=False, include_context=False, include_input=False)
+            await _send_json(send, 422, orjson.dumps({"detail": detail}))
+            return
+        if not math.isfinite(req.pace_value):
+            await _send_json(send, 422, orjson.dumps({"detail": _NON_FINITE_PACE_DETAIL}))
+            return
+
+        try:
+            bpm = pace_to_bpm(
+                pace_value=req.pace_value,
+                pace_unit=req.pace_unit,
+                run_type=req.run_type,
+                baseline_cadence=req.baseline_cadence,
+                target_cadence=req.target_cadence,
+            )
+        except (ValueError, OverflowError):
+            # inputs the kernel can't convert are a client error, not a bare 500
+            await _send_json(send, 422, b'{"detail":"pace could not be converted"}')
+            return
+        await _send_json(send, 200, b'{"bpm":%d}' % bpm)
@@ -3,13 +3,16 @@ Database Helper Functions
 
 MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
+All helpers are async (Motor) so request handlers can await them on the event loop.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
+import asyncio
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import AsyncIterator, List, Optional, Set, Tuple, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
@@ -22,34 +25,132 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # Sized for many concurrent handlers; fail fast instead of queueing when Mongo is unreachable
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "10")),
+        waitQueueTimeoutMS=2000,
+        serverSelectionTimeoutMS=2000,
+        compressors="zstd",
+    )
     db = _client[database_name]
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
-    if db is None:
-        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
-
-    # Convert Pydantic model to dict if needed
+def _prepare_document(data: Union[BaseModel, dict]) -> dict:
+    # Convert Pydantic model to dict if needed; model_dump already returns a fresh dict
     if isinstance(data, BaseModel):
-        data_dict = data.model_dump()
+        data_dict = data.model_dump(mode="python")
     else:
-        data_dict = data.copy()
+        data_dict = dict(data)
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
+    return data_dict
 
-    result = db[collection_name].insert_one(data_dict)
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with timestamp"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    data_dict = _prepare_document(data)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None, sort: list = None, projection: dict = None):
+    """Get documents from collection, optionally ordered by a list of (field, direction) pairs"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
     
-    cursor = db[collection_name].find(filter_dict or {})
+    cursor = db[collection_name].find(filter_dict or {}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    # cursor.limit already bounds the result (0 = no limit, negative = single batch, as in PyMongo)
+    return await cursor.to_list(length=None)
+
+async def get_one(collection_name: str, filter_dict: dict = None, projection: dict = None):
+    """Get the first document matching the filter, or None"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    return await db[collection_name].find_one(filter_dict or {}, projection)
+
+async def stream_documents(collection_name: str, filter_dict: dict = None, limit: int = None, sort: list = None,
+                           batch_size: int = 256) -> AsyncIterator[List[dict]]:
+    """Yield documents one server batch at a time, so each batch can be flushed as soon as it arrives"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    cursor = db[collection_name].find(filter_dict or {}).batch_size(batch_size)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    # to_list stops once it holds `batch_size` documents, which is one find/getMore reply
+    while True:
+        docs = await cursor.to_list(length=batch_size)
+        if not docs:
+            break
+        yield docs
+
+
+class InsertBatcher:
+    """
+    Coalesce concurrent inserts into one collection into a single insert_many.
+    The first insert of a window arms a timer; the batch is written when the timer fires
+    or when max_batch documents are waiting, whichever comes first. Each caller gets
+    back the id of its own document, like create_document.
+    """
+
+    def __init__(self, collection_name: str, window_seconds: float = 0.02, max_batch: int = 64):
+        self.collection_name = collection_name
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes: Set[asyncio.Task] = set()
+
+    async def insert(self, data: Union[BaseModel, dict]) -> str:
+        if db is None:
+            raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((_prepare_document(data), future))
+        if len(self._pending) >= self.max_batch:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_seconds, self._dispatch)
+        return await future
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: List[Tuple[dict, asyncio.Future]]):
+        # insert_many assigns _id to each document in place, so ids are read back from the docs
+        failed = {}
+        try:
+            await db[self.collection_name].insert_many([doc for doc, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"]: e for err in e.details.get("writeErrors", [])}
+        except Exception as e:
+            failed = {i: e for i in range(len(batch))}
+        for i, (doc, future) in enumerate(batch):
+            if future.done():
+                continue
+            if i in failed:
+                future.set_exception(failed[i])
+            else:
+                future.set_result(str(doc["_id"]))
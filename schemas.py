@@ -50,8 +50,8 @@ class ProEntitlement(BaseModel):
 class AuthCode(BaseModel):
     """One-time verification code for passwordless sign-in."""
     email: str = Field(..., description="Email to verify")
-    code: str = Field(..., description="One-time code as plain text (demo)")
-    expires_in_minutes: int = Field(10, description="Validity window in minutes")
+    nonce: str = Field(..., description="Random nonce the code is derived from (code itself is not stored)")
+    expires_at: int = Field(..., description="Expiry as Unix seconds")
 
 # Example schemas retained for reference (not used by app directly)
 class User(BaseModel):
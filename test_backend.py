@@ -24,6 +24,65 @@ def test_pace_to_bpm():
     assert 120 <= data["bpm"] <= 220
 
 
+def test_pace_to_bpm_follows_anchor_curve():
+    from bpm import pace_to_bpm
+
+    # tempo has no offset, so anchor paces map straight onto the anchor cadences
+    anchors = {3.0: 200, 4.0: 185, 5.0: 170, 6.0: 160, 7.0: 150, 8.0: 145}
+    for pace, bpm in anchors.items():
+        assert pace_to_bpm(pace, run_type="tempo") == bpm
+    assert pace_to_bpm(5.5, run_type="tempo") == 165
+    # paces outside the anchors clamp to the end points
+    assert pace_to_bpm(2.0, run_type="tempo") == 200
+    assert pace_to_bpm(9.5, run_type="tempo") == 145
+
+    # off-grid paces are quantized to the table's 0.01 min/km steps
+    assert pace_to_bpm(5.1338, "min_per_km", "recovery", 190, 160) == pace_to_bpm(5.13, "min_per_km", "recovery", 190, 160)
+    assert pace_to_bpm(5.1362, run_type="easy") == pace_to_bpm(5.14, run_type="easy")
+
+
+def test_fast_pace_to_bpm_matches_regular_route():
+    body = {"pace_value": 6.2, "pace_unit": "min_per_mile", "run_type": "long", "target_cadence": 175}
+    r = client.post("/fast/api/convert/pace-to-bpm", json=body)
+    assert r.status_code == 200
+    assert r.json() == client.post("/api/convert/pace-to-bpm", json=body).json()
+
+    r2 = client.post("/fast/api/convert/pace-to-bpm", json={"pace_unit": "min_per_km"})
+    assert r2.status_code == 422
+
+
+def test_pace_to_bpm_rejects_non_finite_pace():
+    from bpm import pace_to_bpm
+
+    assert pace_to_bpm(float("nan")) == 140
+    for path in ("/api/convert/pace-to-bpm", "/fast/api/convert/pace-to-bpm"):
+        r = client.post(path, content=b'{"pace_value": NaN}', headers={"Content-Type": "application/json"})
+        assert r.status_code == 422
+    r2 = client.get("/api/convert/pace-to-bpm", params={"pace_value": "nan"})
+    assert r2.status_code == 422
+
+
+def test_fast_pace_to_bpm_turns_kernel_errors_into_422(monkeypatch):
+    import bpm
+
+    def broken(**kwargs):
+        raise ValueError("boom")
+
+    monkeypatch.setattr(bpm, "pace_to_bpm", broken)
+    r = client.post("/fast/api/convert/pace-to-bpm", json={"pace_value": 5.0})
+    assert r.status_code == 422
+
+def test_pace_to_bpm_get_is_cacheable():
+    params = {"pace_value": 5.0, "run_type": "tempo"}
+    r = client.get("/api/convert/pace-to-bpm", params=params)
+    assert r.status_code == 200
+    assert r.json() == client.post("/api/convert/pace-to-bpm", json=params).json()
+    assert "max-age" in r.headers["cache-control"]
+
+    r2 = client.get("/api/convert/pace-to-bpm", params=params, headers={"If-None-Match": r.headers["etag"]})
+    assert r2.status_code == 304
+
+
 def test_auth_request_and_verify_dev_mode():
     # request code
     email = "test@example.com"
@@ -40,6 +99,41 @@ def test_auth_request_and_verify_dev_mode():
     # pro_token may be None if no entitlement yet
 
 
+def test_auth_code_not_stored_and_single_use():
+    from main import mem_find
+    email = "hmac@example.com"
+    r = client.post("/api/auth/request-code", json={"email": email})
+    code = r.json()["debug_code"]
+    stored = mem_find("authcode", {"email": email})
+    assert stored and all("code" not in rec for rec in stored)
+
+    r2 = client.post("/api/auth/verify-code", json={"email": email, "code": code})
+    assert r2.status_code == 200
+    # consumed on success
+    r3 = client.post("/api/auth/verify-code", json={"email": email, "code": code})
+    assert r3.status_code == 401
+
+    client.post("/api/auth/request-code", json={"email": email})
+    r4 = client.post("/api/auth/verify-code", json={"email": email, "code": "é12345"})
+    assert r4.status_code == 401
+
+
+def test_auth_code_expiry_and_stale_records():
+    import time
+    from main import _auth_code, mem_insert
+
+    email = "stale@example.com"
+    expired_at = int(time.time()) - 1
+    for i in range(25):
+        mem_insert("authcode", {"email": email, "nonce": f"old{i}", "expires_at": expired_at})
+    r = client.post("/api/auth/verify-code", json={"email": email, "code": _auth_code(email, "old0", expired_at)})
+    assert r.status_code == 401
+
+    code = client.post("/api/auth/request-code", json={"email": email}).json()["debug_code"]
+    r2 = client.post("/api/auth/verify-code", json={"email": email, "code": code})
+    assert r2.status_code == 200
+
+
 def test_claim_without_entitlement():
     r = client.post("/api/pro/claim", json={"email": "nopro@example.com"})
     assert r.status_code == 404
@@ -97,3 +191,215 @@ def test_webhook_entitlement_and_claim_jwt():
     r4 = client.post("/api/stripe/webhook", json=event)
     assert r4.status_code == 200
     assert r4.json()["status"] == "already_processed"
+
+
+def test_list_sessions_sees_new_session_after_cached_read():
+    user_id = "cache-runner@example.com"
+    r = client.get("/api/sessions", params={"user_id": user_id})
+    assert r.status_code == 200
+    assert r.json()["items"] == []
+
+    session = {"user_id": user_id, "pace_value": 5.0, "target_bpm": 170, "duration_seconds": 600}
+    r2 = client.post("/api/sessions", json=session)
+    assert r2.status_code == 200
+
+    # The POST must invalidate the cached (empty) list for this query
+    r3 = client.get("/api/sessions", params={"user_id": user_id})
+    assert r3.status_code == 200
+    assert [it["_id"] for it in r3.json()["items"]] == [r2.json()["id"]]
+
+
+def test_list_cache_ignores_read_that_straddles_a_write(monkeypatch):
+    import main
+
+    user_id = "straddle@example.com"
+    session = {"user_id": user_id, "pace_value": 5.0, "target_bpm": 170, "duration_seconds": 600}
+    real_get_documents = main.get_documents
+    calls = []
+
+    async def slow_read(*args, **kwargs):
+        # the first read returns what it saw before a session is written mid-flight
+        if not calls:
+            calls.append(1)
+            main.mem_insert("session", session)
+            main._invalidate_list_cache("session")
+            return []
+        return await real_get_documents(*args, **kwargs)
+
+    monkeypatch.setattr(main, "get_documents", slow_read)
+    assert client.get("/api/sessions", params={"user_id": user_id}).json()["items"] == []
+    r = client.get("/api/sessions", params={"user_id": user_id})
+    assert len(r.json()["items"]) == 1
+
+def test_list_sessions_keyset_pagination():
+    user_id = "pager@example.com"
+    ids = []
+    for bpm in (160, 165, 170):
+        session = {"user_id": user_id, "pace_value": 5.5, "target_bpm": bpm, "duration_seconds": 300}
+        ids.append(client.post("/api/sessions", json=session).json()["id"])
+
+    r = client.get("/api/sessions", params={"user_id": user_id, "limit": 2})
+    assert r.status_code == 200
+    page1 = r.json()
+    assert [it["_id"] for it in page1["items"]] == ids[:2]
+    assert page1["next_cursor"] == ids[1]
+
+    r2 = client.get("/api/sessions", params={"user_id": user_id, "limit": 2, "after_id": page1["next_cursor"]})
+    assert r2.status_code == 200
+    page2 = r2.json()
+    assert [it["_id"] for it in page2["items"]] == ids[2:]
+    assert page2["next_cursor"] is None
+
+
+def test_stream_sessions_ndjson():
+    user_id = "streamer@example.com"
+    session = {"user_id": user_id, "pace_value": 4.5, "target_bpm": 178, "duration_seconds": 1200}
+    sid = client.post("/api/sessions", json=session).json()["id"]
+
+    r = client.get("/api/sessions/stream", params={"user_id": user_id})
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in r.text.splitlines()]
+    assert [row["_id"] for row in rows] == [sid]
+    assert rows[0]["target_bpm"] == 178
+
+
+def test_list_profiles_projects_profile_fields():
+    r = client.put("/api/profile", json={"user_id": "projected@example.com", "baseline_cadence": 168})
+    assert r.status_code == 200
+
+    r2 = client.get("/api/profiles", params={"limit": 50})
+    assert r2.status_code == 200
+    items = [it for it in r2.json()["items"] if it["user_id"] == "projected@example.com"]
+    assert items and items[0]["_id"] == r.json()["id"]
+    assert items[0]["baseline_cadence"] == 168
+    assert "updated_at" not in items[0]
+
+
+def test_list_sessions_pro_flag_from_bearer_token():
+    from main import mint_jwt
+
+    token = mint_jwt(email="bearer@example.com")
+    r = client.get("/api/sessions", headers={"Authorization": f"Bearer {token}"})
+    assert r.status_code == 200
+    assert r.json()["pro"] is True
+
+    tampered = token[:-2] + ("AA" if not token.endswith("AA") else "BB")
+    r2 = client.get("/api/sessions", headers={"Authorization": f"Bearer {tampered}"})
+    assert r2.status_code == 200
+    assert r2.json()["pro"] is False
+
+
+def test_fast_verified_token_not_trusted_by_strict_verify():
+    import hashlib
+    import hmac
+    import time
+    import orjson
+    import auth
+
+    # correctly signed, but without the iat claim that strict decoding requires
+    claims = {"sub": "noiat", "pro": True, "iss": auth.JWT_ISSUER, "aud": auth.JWT_AUDIENCE, "exp": int(time.time()) + 60}
+    signing_input = auth._JWT_HEADER_SEGMENT + b"." + auth.base64url_encode(orjson.dumps(claims))
+    signature = hmac.new(auth.JWT_SECRET_BYTES, signing_input, hashlib.sha256).digest()
+    token = (signing_input + b"." + auth.base64url_encode(signature)).decode("ascii")
+
+    r = client.get("/api/sessions", headers={"Authorization": f"Bearer {token}"})
+    assert r.json()["pro"] is True
+    r2 = client.post("/api/pro/verify", params={"token": token})
+    assert r2.status_code == 401
+
+
+def _stripe_signature(secret: str, payload: bytes, timestamp: int) -> str:
+    import hashlib
+    import hmac
+
+    mac = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={mac}"
+
+
+def test_signed_webhook_verification(monkeypatch):
+    import time
+    import main
+
+    secret = "whsec_test_secret"
+    monkeypatch.setattr(main, "STRIPE_WEBHOOK_SECRET", secret)
+    monkeypatch.setattr(main, "_STRIPE_SECRET_BYTES", secret.encode("utf-8"))
+    payload = json.dumps({"id": "evt_signed_1", "type": "customer.created", "data": {"object": {}}}).encode()
+
+    good = _stripe_signature(secret, payload, int(time.time()))
+    r = client.post("/api/stripe/webhook", content=payload, headers={"Stripe-Signature": good})
+    assert r.status_code == 200
+    assert r.json()["status"] == "unhandled"
+
+    bad = _stripe_signature("whsec_other", payload, int(time.time()))
+    r2 = client.post("/api/stripe/webhook", content=payload, headers={"Stripe-Signature": bad})
+    assert r2.status_code == 400
+
+    stale = _stripe_signature(secret, payload, int(time.time()) - 3600)
+    r3 = client.post("/api/stripe/webhook", content=payload, headers={"Stripe-Signature": stale})
+    assert r3.status_code == 400
+
+
+def test_rate_store_evicts_least_recently_used(monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "RATE_STORE_MAX_KEYS", 2)
+    monkeypatch.setattr(main, "_rate_store", main.OrderedDict())
+    for key in ("a", "b", "a", "c"):
+        main._check_rate(key, limit=5)
+    assert list(main._rate_store) == ["a", "c"]
+
+
+class _StubCollection:
+    """Records insert_many calls; documents at indexes in fail_indexes come back as write errors."""
+
+    def __init__(self, fail_indexes=()):
+        self.calls = []
+        self.fail_indexes = set(fail_indexes)
+
+    async def insert_many(self, docs, ordered=True):
+        from bson import ObjectId
+        from pymongo.errors import BulkWriteError
+
+        self.calls.append(len(docs))
+        for doc in docs:
+            doc["_id"] = ObjectId()
+        if self.fail_indexes:
+            errors = [{"index": i, "code": 11000, "errmsg": "duplicate key"} for i in sorted(self.fail_indexes)]
+            raise BulkWriteError({"writeErrors": errors})
+
+
+def _run_batched_inserts(monkeypatch, collection, count, **batcher_kwargs):
+    import asyncio
+    import database
+
+    monkeypatch.setattr(database, "db", {"session": collection})
+    batcher = database.InsertBatcher("session", **batcher_kwargs)
+
+    async def run():
+        return await asyncio.gather(*(batcher.insert({"n": i}) for i in range(count)), return_exceptions=True)
+
+    return asyncio.run(run())
+
+
+def test_insert_batcher_flushes_window_as_one_write(monkeypatch):
+    coll = _StubCollection()
+    ids = _run_batched_inserts(monkeypatch, coll, 5, window_seconds=0.01, max_batch=64)
+    assert coll.calls == [5]
+    assert len(set(ids)) == 5 and all(isinstance(i, str) for i in ids)
+
+
+def test_insert_batcher_splits_at_max_batch(monkeypatch):
+    coll = _StubCollection()
+    ids = _run_batched_inserts(monkeypatch, coll, 5, window_seconds=0.01, max_batch=2)
+    assert coll.calls == [2, 2, 1]
+    assert len(set(ids)) == 5
+
+
+def test_insert_batcher_fails_only_rejected_documents(monkeypatch):
+    from pymongo.errors import BulkWriteError
+
+    coll = _StubCollection(fail_indexes=[1])
+    results = _run_batched_inserts(monkeypatch, coll, 3, window_seconds=0.01, max_batch=64)
+    assert isinstance(results[1], BulkWriteError)
+    assert isinstance(results[0], str) and isinstance(results[2], str)